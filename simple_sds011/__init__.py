@@ -2,11 +2,15 @@
 Nova SDS011 particulate matter sensors.
 """
 
+import struct
+import time
+
 import serial
 
 _MSG_HEAD = b'\xaa'  # 0xAA
 _MSG_ID = b'\xb4'    # 0xB4
 _MSG_TAIL = b'\xab'  # 0xAB
+_REPLY_IDS = {0xc0, 0xc5}
 
 _CMD_REPORT_MODE = 2
 _CMD_QUERY = 4
@@ -22,10 +26,52 @@ PERIOD_FIVE = 5
 PERIOD_TEN = 10
 PERIOD_MAX = 30
 
+_PROPERTY_COMMANDS = {
+    'active': _CMD_WAKE_STATE,
+    'firmware': _CMD_FIRMWARE,
+    'mode': _CMD_REPORT_MODE,
+    'period': _CMD_WORK_PERIOD
+}
+
+_PROPERTY_SWITCH = {
+    0x02: 'mode',
+    0x05: 'id',
+    0x06: 'active',
+    0x07: 'firmware',
+    0x08: 'period'
+}
+
+
+def _is_zero_to_one(x):
+    return x in {0,1}
+
+
+def _is_zero_to_thirty(x):
+    return x >= 0 and x <= 30 and x%1 == 0
+
+
+_PROPS_CHECKS = {
+    'active': _is_zero_to_one,
+    'mode': _is_zero_to_one,
+    'period': _is_zero_to_thirty
+}
+
 _BAUDRATE = 9600
 _BYTESIZE = serial.EIGHTBITS
 _PARITY = serial.PARITY_NONE
 _STOPBITS = serial.STOPBITS_ONE
+_WRITE_TIMEOUT = 0.5
+_INTER_BYTE_TIMEOUT = 0.05
+
+_DEV_ID_ALL = b'\xff\xff'
+
+# Head, ID, command, mode, value, ten zero bytes, device ID, checksum, tail.
+_MESSAGE_STRUCT = struct.Struct('<cc3B10x2sBc')
+
+_READ_COMMANDS = (
+    _CMD_REPORT_MODE, _CMD_QUERY, _CMD_WAKE_STATE,
+    _CMD_FIRMWARE, _CMD_WORK_PERIOD
+)
 
 
 class SensorError(Exception):
@@ -44,11 +90,23 @@ class ValueUnknownError(SensorError):
 
 class SDS011:
     def __init__(self, port=None, read_timeout=1):
-        self._sd = serial.Serial(port, timeout=read_timeout)
+        self._sd = serial.Serial(
+            port, baudrate=_BAUDRATE, bytesize=_BYTESIZE, parity=_PARITY,
+            stopbits=_STOPBITS, timeout=read_timeout,
+            write_timeout=_WRITE_TIMEOUT,
+            inter_byte_timeout=_INTER_BYTE_TIMEOUT
+        )
         self.info = {
-            'active': None, 'device_id': None, 'firmware': None,
+            'active': None, 'device_id': _DEV_ID_ALL, 'firmware': None,
             'mode': None, 'period': None
         }
+        # Replies served from info, rebuilt only when the value changes.
+        self._replies = {}
+        # Complete messages for read commands, which never change.
+        self._read_messages = {
+            command: self._build_message(command, 0, 0)
+            for command in _READ_COMMANDS
+        }
 
     def set_up(self, **kwargs):
         """Set up device and instance properties with initial values.
@@ -56,21 +114,36 @@ class SDS011:
         Assign settings on the device from user values, or get current
         values from the device where/when user values are not supplied.
         """
-        is_zero_to_one = lambda x : x in {0,1}
-        is_zero_to_thirty = lambda x : x >= 0 and x <= 30 and x%1 == 0
-        is_two_bytes = lambda x : type(x) is bytes and len(x) == 2
-        props_checks = {
-            'active': is_zero_to_one, #'device_id': is_two_bytes,
-            'mode': is_zero_to_one, 'period': is_zero_to_thirty,
-        }
-
-        for key,check in props_checks.items():
+        props = []
+        commands = []
+        for key,check in _PROPS_CHECKS.items():
             value = kwargs.get(key,-1)
             if check(value):
-                self._rw_property(key,1,value)
+                commands.append((_PROPERTY_COMMANDS[key], 1, value))
+            else:
+                commands.append((_PROPERTY_COMMANDS[key], 0, 0))
+            props.append(key)
+        props.append('firmware')
+        commands.append((_CMD_FIRMWARE, 0, 0))
+
+        replies = self._pipeline(commands)
+        try:
+            for p, reply in zip(props, replies):
+                self._store_reply(p, reply)
+        except ValueUnknownError:
+            # A stray packet may have shifted the replies; drop what is
+            # left so it cannot answer a later request.
+            self.clear()
+            raise
+        if len(replies) < len(commands):
+            # Report on the command whose reply is missing.
+            _, p_set, _ = commands[len(replies)]
+            if p_set:
+                msg = 'Device inactive and unable to set value.'
+                raise DeviceInactiveError(msg)
             else:
-                self._rw_property(key)
-        self._rw_property('firmware')
+                msg = 'Device inactive and value not stored.'
+                raise ValueUnknownError(msg)
 
 
     @property
@@ -87,9 +160,9 @@ class SDS011:
     def device_id(self):
         """The device ID.
 
-        (Unimplemented for now. Returns 'all' byte string.)
+        (Unimplemented for now. Returns the stored 'all' byte string.)
         """
-        return b'\xff\xff'
+        return self.info['device_id']
 
 
     @property
@@ -158,49 +231,55 @@ class SDS011:
 
     def _verify_packet(self, packet):
         """Verify the checksum of a packet."""
-        return packet[8] == self._calc_payload_checksum(packet[2:8])
+        data = memoryview(packet)[2:8]
+        return packet[8] == self._calc_payload_checksum(data)
 
 
-    def _build_message(self, payload):
-        """Given the payload, return the complete packet."""
-        checksum_byte = bytes([self._calc_payload_checksum(payload)])
-        return _MSG_HEAD + _MSG_ID + payload + checksum_byte + _MSG_TAIL
+    def _build_message(self, command, write: bool, value: int):
+        """Given the command and options, return the complete packet."""
+        device_id = self.device_id
+        checksum = self._calc_payload_checksum(
+            (command, write, value, device_id[0], device_id[1])
+        )
+        return _MESSAGE_STRUCT.pack(
+            _MSG_HEAD, _MSG_ID, command, write, value, device_id,
+            checksum, _MSG_TAIL
+        )
 
 
-    def _build_payload(self, command, write: bool, value: int):
-        """Given the command and options, return the packet payload."""
-        payload = bytearray([command, write, value])
-        payload += bytearray(10)
-        payload += self.device_id
-        return payload
+    def _get_message(self, command, write: bool, value: int):
+        """Return the packet for a command, cached for read commands."""
+        if not write and not value:
+            return self._read_messages[command]
+        return self._build_message(command, write, value)
 
 
     def _rw_property(self, p, p_set=0, p_value=0):
-        p_switch = {
-            'active': _CMD_WAKE_STATE,
-            'firmware': _CMD_FIRMWARE,
-            'mode': _CMD_REPORT_MODE,
-            'period': _CMD_WORK_PERIOD
-        }
-        if self.info[p] is not None and not p_set:
-            # If read request and value stored, return it from memory.
-            return {
-                'type': p,
-                'set': 0,
-                'value': self.info[p],
-                'id': self.device_id,
-                'checksum': True
-            }
+        stored = self.info[p]
+        # The device sleeps and wakes by itself during work periods, so
+        # a stored 'active' value can be stale; always send its writes.
+        if stored is not None and (
+                not p_set or (stored == p_value and p != 'active')):
+            # If read request, or write request of the value already
+            # stored, return it from memory.
+            reply = self._replies.get(p)
+            if reply is None or reply['value'] != stored:
+                reply = {
+                    'type': p,
+                    'set': 0,
+                    'value': stored,
+                    'id': self.device_id,
+                    'checksum': True
+                }
+                self._replies[p] = reply
+            return reply
         else:
-            # If write request or value not in memory, go to device;
+            # If new write request or value not in memory, go to device;
             # and set the stored value along the way.
             try:
-                self._send_command(p_switch[p], p_set, p_value)
+                self._send_command(_PROPERTY_COMMANDS[p], p_set, p_value)
                 response = self._get_response()
-                if response['checksum'] is not True:
-                    msg = 'Device response checksum does not match.'
-                    raise ValueUnknownError(msg)
-                self.info[p] = response['value']
+                self._store_reply(p, response)
                 return response
             except serial.serialutil.SerialException:
                 raise  # Not connected or other serial error.
@@ -218,9 +297,9 @@ class SDS011:
 
         Return an interpreted dict by default, raw bytes otherwise.
         """
-        response = self._sd.read(10)
+        response = self._read_exactly(10)
         if interpret:
-            response = self.interpret(response)
+            response = self.interpret(memoryview(response))
         return response
 
 
@@ -230,14 +309,7 @@ class SDS011:
         Translate a response packet from property get/set into
         a human-readable dictionary.
         """
-        property_switch = {
-            0x02: 'mode',
-            0x05: 'id',
-            0x06: 'active',
-            0x07: 'firmware',
-            0x08: 'period'
-        }
-        reply_part = {'type': property_switch[bytestring[2]]}
+        reply_part = {'type': _PROPERTY_SWITCH[bytestring[2]]}
         if reply_part['type'] == 'firmware':
             year = 2000 + bytestring[3]
             month = bytestring[4]
@@ -254,16 +326,109 @@ class SDS011:
         Translate a response packet from a sample request into
         a human-readable dictionary.
         """
+        if len(bytestring) < 10:
+            # Short reply; fail like the other fixed-offset reads do.
+            raise IndexError('sample response too short')
+        pm25, pm100 = struct.unpack_from('<HH', bytestring, 2)
         reply_part = {
             'type': 'sample',
-            'value': {
-                'pm2.5': int.from_bytes(bytestring[2:4], 'little')/10,
-                'pm10.0': int.from_bytes(bytestring[4:6], 'little')/10
-            }
+            'value': {'pm2.5': pm25/10, 'pm10.0': pm100/10}
         }
         return reply_part
 
 
+    def _interpret_sample_fast(self, bytestring):
+        """query() sub-function: sample responses.
+
+        Translate a response packet known to be a sample straight into
+        the full interpret() dictionary, skipping the reply dispatch.
+        """
+        checksum = self._verify_packet(bytestring)
+        pm25, pm100 = struct.unpack_from('<HH', bytestring, 2)
+        return {
+            'type': 'sample',
+            'value': {'pm2.5': pm25/10, 'pm10.0': pm100/10},
+            'set': bytestring[3],
+            'id': bytes(bytestring[6:8]),
+            'checksum': checksum
+        }
+
+
+    def _pipeline(self, commands):
+        """Send several commands at once and return their replies.
+
+        Takes (command, write, value) tuples and sends all messages in one
+        write. The device answers commands in order, so replies are read
+        one at a time, each with the full read timeout, and returned in
+        command order. The list stops short at the first missing reply,
+        and the rest of the batch is read and dropped so that late
+        replies cannot answer later requests.
+        """
+        self._sd.write(b''.join(
+            self._get_message(command, write, value)
+            for command, write, value in commands
+        ))
+        replies = []
+        try:
+            for _ in commands:
+                replies.append(self._get_response())
+        except IndexError:
+            pass  # Missing reply; the list stops here.
+        finally:
+            if len(replies) < len(commands):
+                self._read_exactly(10 * (len(commands) - len(replies) - 1))
+                self.clear()
+        return replies
+
+
+    def _read_exactly(self, size):
+        """Read size bytes starting at a response head.
+
+        Skip any bytes ahead of a response head (0xAA 0xC0 or 0xAA 0xC5)
+        and keep reading until size bytes arrive, a read returns nothing,
+        or the read timeout has run out. The port timeouts are left as
+        they are, so a call can overrun the read timeout by one last
+        read, which the inter-byte timeout usually cuts short.
+        Returns what was read, which may be short.
+        """
+        timeout = self._sd.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        buf = bytearray()
+        while True:
+            chunk = self._sd.read(size - len(buf))
+            if not chunk:
+                break
+            buf += chunk
+            head = 0
+            while True:
+                head = buf.find(_MSG_HEAD, head)
+                if head < 0:
+                    head = len(buf)
+                    break
+                if head + 1 == len(buf) or buf[head + 1] in _REPLY_IDS:
+                    break
+                head += 1
+            del buf[:head]
+            if len(buf) >= size:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        return bytes(buf)
+
+
+    def _store_reply(self, p, reply):
+        """Check a device reply to a request for property p, then
+        store its value in info.
+        """
+        if reply['checksum'] is not True:
+            msg = 'Device response checksum does not match.'
+            raise ValueUnknownError(msg)
+        if reply['type'] != p:
+            msg = 'Device response does not match request.'
+            raise ValueUnknownError(msg)
+        self.info[p] = reply['value']
+
+
     def _send_command(self, command, write: bool, value: int):
         """Send a command to the device.
 
@@ -271,12 +436,7 @@ class SDS011:
         a checksummed packet, and sends this to the device.
         Returns return code from device, but not device reply.
         """
-        payload = bytearray([command, write, value])
-        payload += bytearray(10)
-        payload += self.device_id
-        checksum = bytes([sum(payload) & 255])
-        message = _MSG_HEAD + _MSG_ID + payload + checksum + _MSG_TAIL
-        return self._sd.write(message)
+        return self._sd.write(self._get_message(command, write, value))
 
 
     def clear(self):
@@ -295,14 +455,18 @@ class SDS011:
             checksum: bool
         }
         """
-        switch = {
-            0xc5: lambda : self._interpret_property(bytestring),
-            0xc0: lambda : self._interpret_sample(bytestring),
-        }
-        reply = switch[bytestring[1]]()
-        reply['set'] = bytestring[3]
-        reply['id'] = bytestring[6:8]
-        reply['checksum'] = bytestring[8] == sum(bytestring[2:8]) & 255
+        reply_type = bytestring[1]
+        if reply_type == 0xc5:
+            reply = self._interpret_property(bytestring)
+        elif reply_type == 0xc0:
+            reply = self._interpret_sample(bytestring)
+        else:
+            raise KeyError(reply_type)
+        reply.update(
+            set=bytestring[3],
+            id=bytes(bytestring[6:8]),
+            checksum=self._verify_packet(bytestring)
+        )
         return reply
 
 
@@ -316,5 +480,9 @@ class SDS011:
     def query(self):
         """Request a sample datum."""
         self._send_command(_CMD_QUERY, 0, 0)
-        return self._get_response()
+        response = self._get_response(interpret=False)
+        if len(response) == 10 and response[1] == 0xc0:
+            return self._interpret_sample_fast(memoryview(response))
+        # Short or unexpected reply; interpret() raises or sorts it out.
+        return self.interpret(memoryview(response))
 